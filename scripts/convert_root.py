@@ -204,8 +204,8 @@ def main():
             ]
 
             # This information should already be in the MC info
-            nu_1 = stu(mc_info[nu_1_vars]).astype(np.float32)
-            nu_2 = stu(mc_info[nu_2_vars]).astype(np.float32)
+            nu_1 = stu(mc_info[nu_1_vars]).astype(np.float32, copy=False)
+            nu_2 = stu(mc_info[nu_2_vars]).astype(np.float32, copy=False)
             neutrinos = np.dstack([nu_1, nu_2]).transpose((0, 2, 1))
             inFile.close()
 
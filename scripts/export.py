@@ -9,6 +9,7 @@ import logging
 import h5py
 import hydra
 import torch as T
+from lightning.pytorch.callbacks import BasePredictionWriter
 from omegaconf import DictConfig
 
 from mltools.mltools.hydra_utils import reload_original_config
@@ -19,6 +20,48 @@ from models.nuflows import NuFlows
 log = logging.getLogger(__name__)
 
 
+class H5PredictionWriter(BasePredictionWriter):
+    """Streams predictions into an HDF5 file batch by batch.
+
+    Keeps peak memory bounded to a single batch instead of materialising the
+    full combined prediction dict in RAM before writing.
+    """
+
+    def __init__(self, file_path: Path) -> None:
+        super().__init__(write_interval="batch")
+        self.file_path = Path(file_path)
+        self.file = None
+
+    def write_on_batch_end(
+        self, _trainer, _pl_module, prediction, _batch_indices, _batch, _batch_idx, _dataloader_idx
+    ) -> None:
+        if self.file is None:
+            self.file_path.parent.mkdir(exist_ok=True, parents=True)
+            self.file = h5py.File(self.file_path, "w")
+        for key, val in prediction.items():
+            arr = to_np(val if val.ndim > 1 else val.unsqueeze(1))
+            if key not in self.file:
+                # Shuffle + LZF is cheap to encode and typically halves the
+                # float32 output; chunks align with the batch row stride
+                self.file.create_dataset(
+                    key,
+                    shape=(0, *arr.shape[1:]),
+                    maxshape=(None, *arr.shape[1:]),
+                    chunks=(min(8192, len(arr)), *arr.shape[1:]),
+                    dtype=arr.dtype,
+                    compression="lzf",
+                    shuffle=True,
+                )
+            dset = self.file[key]
+            dset.resize(dset.shape[0] + len(arr), axis=0)
+            dset[-len(arr) :] = arr
+
+    def on_predict_end(self, _trainer, _pl_module) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 @hydra.main(version_base=None, config_path=str(root / "configs"), config_name="export.yaml")
 def main(cfg: DictConfig) -> None:
     log.info("Loading run information")
@@ -35,35 +78,24 @@ def main(cfg: DictConfig) -> None:
     # Switch settings for the export
     orig_cfg.datamodule.loader_conf.batch_size = cfg.batch_size
 
+    # Pinned staging buffers let Lightning's batch transfer run the
+    # host-to-device copy asynchronously instead of blocking the predict loop
+    orig_cfg.datamodule.loader_conf.pin_memory = True
+
     # Load the test datasets and run the predictions
     datamodule = hydra.utils.instantiate(orig_cfg.datamodule)
 
+    output_file_path = Path("outputs") / f"test-{model.samples_per_event}.h5"
+    log.info(f"Predictions will stream to {output_file_path}")
+    writer = H5PredictionWriter(output_file_path)
+
     log.info("Instantiating the trainer")
     orig_cfg.trainer["enable_progress_bar"] = True
     orig_cfg.trainer["logger"] = False  # Prevents a lightning_logs folder
-    trainer = hydra.utils.instantiate(orig_cfg.trainer)
+    trainer = hydra.utils.instantiate(orig_cfg.trainer, callbacks=[writer])
 
     log.info("Running the prediction loop")
-    outputs = trainer.predict(model=model, datamodule=datamodule)
-
-    log.info("Combining predictions across dataset")
-    keys = list(outputs[0].keys())
-    comb_dict = {}
-    for k in keys:
-        outs = [o[k] for o in outputs]
-        if outs[0].ndim == 1:
-            outs = [o.unsqueeze(1) for o in outs]
-        comb_dict[k] = T.vstack(outs)
-        log.debug(f'{k}: {comb_dict[k].shape}')
-
-    log.info("Saving Outputs")
-    output_dir_path = Path("outputs")
-    output_dir_path.mkdir(exist_ok=True, parents=True)
-    output_file_path = output_dir_path / f"test-{model.samples_per_event}.h5"
-    log.info(f"Saving to {output_file_path}")
-    with h5py.File(output_file_path, "w") as file:
-        for key, v in comb_dict.items():
-            file.create_dataset(key, data=to_np(v))
+    trainer.predict(model=model, datamodule=datamodule, return_predictions=False)
 
 
 if __name__ == "__main__":
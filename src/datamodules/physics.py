@@ -7,6 +7,23 @@ import torch as T
 
 from mltools.mltools.torch_utils import empty_0dim_like
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _to_cartesian_kernel(data: np.ndarray, out: np.ndarray) -> None:
+        """Fused pt,eta,phi,E -> px,py,pz,log_energy conversion."""
+        for i in prange(data.shape[0]):
+            pt = data[i, 0]
+            out[i, 0] = pt * np.cos(data[i, 2])
+            out[i, 1] = pt * np.sin(data[i, 2])
+            out[i, 2] = pt * np.sinh(data[i, 1])
+            out[i, 3] = np.log(data[i, 3] + 1e-8)
+
 
 class Mom4Vec:
     """A simple class that contains the four vectors of events in either px, py, pz, E
@@ -320,6 +337,15 @@ def change_from_ptetaphiE(
     # Calculate the number of kinematic features in the final dimension
     n_dim = n_dim or min(4, data.shape[-1])
 
+    # Fast path: the default cartesian target is one fused elementwise kernel
+    # which numba compiles without the per-expression ufunc temporaries
+    if njit is not None and n_dim == 4 and new_names == ["px", "py", "pz", "log_energy"]:
+        flat = np.ascontiguousarray(data.reshape(-1, data.shape[-1]), dtype=np.float32)
+        out = np.empty_like(flat)
+        _to_cartesian_kernel(flat, out)
+        out[:, 4:] = flat[:, 4:]
+        return out.reshape(*data.shape[:-1], out.shape[-1]), new_names + list(old_names[4:])
+
     # Create the slices
     pt = data[..., 0:1]
     eta = data[..., 1:2] if n_dim > 2 else empty_0dim_like(data)
@@ -362,6 +388,38 @@ def change_from_ptetaphiE(
     return new_vals, new_names
 
 
+def change_many_from_ptetaphiE(
+    datas: list, old_cords: list, new_cords: list, n_dim: int = 0
+) -> tuple[list, list]:
+    """Convert several collections that share the same coordinates in one pass.
+
+    The arrays are flattened and concatenated along the leading axis so the
+    conversion ufuncs walk a single contiguous buffer instead of one small
+    buffer per collection, then the result is split back into the original
+    shapes.
+
+    Args:
+        datas: The collections to convert, sharing the same final dimension
+        old_cords: The current names of the coords (common to all datas)
+        new_cords: The new coords to calculate
+        n_dim: The number of dimensions to transform, if 0 it will be assumed
+
+    Returns
+    -------
+        new_values (one array per input), new_names
+    """
+    flat = [d.reshape(-1, d.shape[-1]) for d in datas]
+    bounds = np.cumsum([len(f) for f in flat])[:-1]
+    comb, new_names = change_from_ptetaphiE(
+        np.concatenate(flat, axis=0), old_cords, new_cords, n_dim
+    )
+    outs = [
+        c.reshape(*d.shape[:-1], comb.shape[-1])
+        for c, d in zip(np.split(comb, bounds, axis=0), datas, strict=True)
+    ]
+    return outs, new_names
+
+
 def nu_sol_comps(
     lept_px: np.ndarray,
     lept_py: np.ndarray,
@@ -108,6 +108,9 @@ class NuFlows(LightningModule):
             if inpt.ndim == 2:
                 inpt = inpt.unsqueeze(1)
 
+            # The dataset may store at reduced precision, cast after transfer
+            inpt = inpt.float()
+
             # Build the mask
             if self.disable_masking:
                 mask = None
@@ -133,7 +136,7 @@ class NuFlows(LightningModule):
 
     def get_targets(self, targets: dict) -> T.Tensor:
         """Unpack the target dictionary as a single tensor."""
-        return self.target_norm(T.cat(tuple(targets.values()), dim=-1))
+        return self.target_norm(T.cat(tuple(targets.values()), dim=-1).float())
 
     def pack_outputs(self, outputs: T.Tensor) -> dict:
         """Pack the targets of the flow into a dictionary."""